@@ -0,0 +1,34 @@
+#stand-ins for the venus os modules (dbus, gi, ext/velib_python) so that the checks can run on any system
+#the real modules are used when they are available
+import os
+import sys
+import types
+
+sys.path.insert(1, os.path.join(os.path.dirname(__file__), 'ext', 'velib_python'))
+
+def stub(name, **attributes):
+    module=types.ModuleType(name)
+    module.__dict__.update(attributes)
+    sys.modules[name]=module
+    return module
+
+try:
+    import dbus
+    import dbus.mainloop.glib
+    import dbus.service
+except ImportError:
+    dbus=stub('dbus', Boolean=bool)
+    dbus.mainloop=stub('dbus.mainloop')
+    dbus.mainloop.glib=stub('dbus.mainloop.glib')
+    dbus.service=stub('dbus.service')
+
+try:
+    from gi.repository import GLib
+except ImportError:
+    gi=stub('gi')
+    gi.repository=stub('gi.repository', GLib=None)
+
+try:
+    import vedbus
+except ImportError:
+    stub('vedbus', VeDbusService=None, VeDbusItemImport=None)
@@ -12,6 +12,8 @@ import sys
 from time import tzset
 from datetime import datetime, timedelta, timezone
 import traceback
+import math
+import subprocess
 from gi.repository import GLib
 
 # Import des modules locaux (sous dossier /ext/velib_python)
@@ -34,6 +36,25 @@ LOGFILE = '/solcastforecast.log'
 
 UPDATE_INTERVAL = 250
 
+#site location used to calculate daylight hours (decimal degrees, north and east positive)
+SITE_LATITUDE = 48.85
+SITE_LONGITUDE = 2.35
+
+#number of calls allowed per day by the solcast api key (10 for hobbyist accounts)
+SOLCAST_DAILY_LIMIT = 10
+#minutes before a 30 mn out_max calculation when a planned call to solcast api is started
+FETCH_LEAD = 5
+#seconds below which the cached forecast is considered fresh enough to defer a planned call
+FETCH_MIN_AGE = 1200
+#seconds between two calls when the cached forecast does not cover the calculation horizon
+FETCH_RETRY_INTERVAL = 1800
+#calls of the quota day allowed before sunrise when the cached forecast is not usable, others are kept for daylight
+FETCH_NIGHT_RETRIES = 2
+#seconds after which a call to solcast api is aborted
+FETCH_TIMEOUT = 60
+#seconds after which the cached forecast is too old to be used by the out_max calculation
+FORECAST_MAX_AGE = 86400
+
 # Adjusting time zone as system is not aligned with the time zone set in the UI 
 os.environ['TZ'] = 'Europe/Paris'
 tzset()
@@ -116,6 +137,192 @@ class EnergyCalculator(object):
         #
         return self.meters
 
+class FetchPlanner(object):
+    # plans the calls to solcast api within the daily quota
+    # calls run in background and write into the production forecast cache file
+    def __init__(self, file_path, url):
+        self.file_path=file_path
+        self.url=url
+        #calls used on the current utc day (solcast resets the quota at 00:00 utc)
+        self.quota={'date' : None, 'used' : 0}
+        #planned start times of the calls for the current day
+        self.plan=[]
+        self.plan_key=None
+        self.sunrise=None
+        self.sunset=None
+        self.process=None
+        self.last_call=None
+        self.__read_quota__()
+
+    #to load the number of calls already used today (saved in a file to survive restarts)
+    def __read_quota__(self):
+        filename=self.file_path+'/solcast_quota.json'
+        if os.path.isfile(filename):
+            try:
+                with open(filename, mode="r", encoding="utf-8") as file:
+                    quota = json.load(file)
+                if (not isinstance(quota.get('date'), str)
+                    or not isinstance(quota.get('used'), int) or isinstance(quota['used'], bool)):
+                    raise ValueError(f'unexpected content: {quota}')
+                self.quota = {'date' : quota['date'], 'used' : quota['used']}
+            except:
+                log.error('could not read solcast api quota file, quota reset')
+
+    #to save the number of calls used today
+    def __save_quota__(self):
+        filename=self.file_path+'/solcast_quota.json'
+        try:
+            with open(filename, mode="w", encoding="utf-8") as file:
+                json.dump(self.quota, file)
+        except:
+            log.error('could not save solcast api quota file')
+
+    #to get the number of calls left for the current utc day
+    def __remaining__(self, now):
+        today=now.astimezone(timezone.utc).strftime('%Y-%m-%d')
+        if self.quota['date'] != today:
+            self.quota={'date' : today, 'used' : 0}
+        return SOLCAST_DAILY_LIMIT - self.quota['used']
+
+    #to calculate sunrise and sunset (local time) at the site location (NOAA approximation)
+    def __sun_times__(self, day):
+        gamma=2*math.pi/365*(day.timetuple().tm_yday-1)
+        eqtime=229.18*(0.000075+0.001868*math.cos(gamma)-0.032077*math.sin(gamma)
+            -0.014615*math.cos(2*gamma)-0.040849*math.sin(2*gamma))
+        decl=(0.006918-0.399912*math.cos(gamma)+0.070257*math.sin(gamma)
+            -0.006758*math.cos(2*gamma)+0.000907*math.sin(2*gamma)
+            -0.002697*math.cos(3*gamma)+0.00148*math.sin(3*gamma))
+        lat=math.radians(SITE_LATITUDE)
+        #hour angle of the sun crossing the horizon, clamped for polar night and midnight sun
+        ha=math.degrees(math.acos(max(-1, min(1,
+            math.cos(math.radians(90.833))/(math.cos(lat)*math.cos(decl))-math.tan(lat)*math.tan(decl)
+            ))))
+        midnight=datetime(day.year, day.month, day.day, tzinfo=timezone.utc)
+        sunrise=midnight+timedelta(minutes=720-4*(SITE_LONGITUDE+ha)-eqtime)
+        sunset=midnight+timedelta(minutes=720-4*(SITE_LONGITUDE-ha)-eqtime)
+        return sunrise.astimezone().replace(tzinfo=None), sunset.astimezone().replace(tzinfo=None)
+
+    #to identify the plan, renewed when the local day or the utc quota day changes
+    def __plan_key__(self, now):
+        return (now.date(), now.astimezone(timezone.utc).date())
+
+    #to spread the calls left over the out_max calculations still to come during daylight
+    def __plan__(self, now):
+        self.plan_key=self.__plan_key__(now)
+        sunrise, sunset = self.__sun_times__(now.date())
+        self.sunrise, self.sunset = sunrise, sunset
+        #out_max calculations of the day during daylight (up to midnight in case of midnight sun)
+        daylight=[]
+        decision=datetime(now.year, now.month, now.day)+timedelta(minutes=30)
+        while decision <= min(sunset, datetime(now.year, now.month, now.day)+timedelta(days=1)):
+            if decision >= sunrise:
+                daylight.append(decision)
+            decision+=timedelta(minutes=30)
+        decisions=[item for item in daylight if item-timedelta(minutes=FETCH_LEAD) > now]
+        #calls left expire at 00:00 utc, use them all over the remaining daylight
+        calls=min(max(0, self.__remaining__(now)), len(decisions))
+        #first call on the first calculation after sunrise (or after now), others evenly spaced
+        self.plan=[
+            decisions[i*len(decisions)//calls]-timedelta(minutes=FETCH_LEAD) for i in range(calls)
+            ]
+        log.info(
+            f'daylight {sunrise.strftime("%H:%M")}-{sunset.strftime("%H:%M")}, '
+            +f'{calls} solcast api calls planned: '
+            +f'{", ".join(item.strftime("%H:%M") for item in self.plan)}'
+            )
+
+    #to start a call to solcast api in background, answer is written next to the cache file
+    def __start__(self, now):
+        log.debug('Calling Solcast API url')
+        self.last_call=now
+        self.process=subprocess.Popen(
+            f'curl -s -m {FETCH_TIMEOUT} -o {self.file_path}/prod_forecast.json.tmp '+self.url,
+            shell=True
+            )
+        self.__remaining__(now)
+        self.quota['used']+=1
+        self.__save_quota__()
+
+    #to check the call running in background, returns True if the cache file has been updated
+    def __poll__(self):
+        if self.process is None or self.process.poll() is None:
+            return False
+        returncode=self.process.returncode
+        self.process=None
+        filename=self.file_path+'/prod_forecast.json'
+        if returncode:
+            log.error(f'no answer received from Solcast API (curl exit code {returncode})')
+            return False
+        try:
+            with open(filename+'.tmp', mode="r", encoding="utf-8") as file:
+                prod=json.load(file)
+            if prod.get("forecasts"):
+                os.replace(filename+'.tmp', filename)
+                return True
+            elif "response_status" in prod and "error_code" in prod["response_status"]:
+                log.error(f'error received from Solcast API: {prod["response_status"]["error_code"]}')
+                #quota already exhausted on solcast side, stop calling until tomorrow
+                if prod["response_status"]["error_code"] == 'TooManyRequests':
+                    self.quota['used']=SOLCAST_DAILY_LIMIT
+                    self.__save_quota__()
+            else:
+                log.error('unidentified error when contacting Solcast API')
+        except:
+            log.error('non interpretable answer received from Solcast API')
+        return False
+
+    #to get the age of the cached forecast in seconds (None if there is no cache file)
+    def __cache_age__(self, now):
+        filename=self.file_path+'/prod_forecast.json'
+        if not os.path.isfile(filename):
+            return None
+        return now.timestamp()-os.path.getmtime(filename)
+
+    #to check if the cached forecast can be used by the out_max calculation
+    #it must cover today and tomorrow and be younger than FORECAST_MAX_AGE
+    def usable(self, prod_end, now):
+        horizon=datetime(now.year, now.month, now.day)+timedelta(days=2)
+        age=self.__cache_age__(now)
+        return prod_end is not None and prod_end >= horizon and age is not None and age <= FORECAST_MAX_AGE
+
+    #to call solcast api when needed, prod_end is the end of the cached forecast (local time)
+    #returns True when a new forecast is available in the cache file
+    def update(self, prod_end, now=None):
+        now=datetime.now() if now is None else now
+        updated=self.__poll__()
+        if self.process is not None or self.url is None:
+            return updated
+        if self.plan_key != self.__plan_key__(now):
+            self.__plan__(now)
+        if self.__remaining__(now) <= 0:
+            return updated
+        due=False
+        while self.plan and self.plan[0] <= now:
+            self.plan.pop(0)
+            due=True
+        if not self.usable(prod_end, now):
+            retry=self.last_call is None or (now-self.last_call).total_seconds() >= FETCH_RETRY_INTERVAL
+            #before sunrise keep the quota for the daylight calls
+            #after sunset the calls left are lost at 00:00 utc anyway
+            reserved=now < self.sunrise and self.quota['used'] >= FETCH_NIGHT_RETRIES
+            if retry and not reserved:
+                log.info('cached production forecast outdated or not covering today and tomorrow, calling solcast api')
+                self.__start__(now)
+                #spread the calls left over the rest of the day
+                self.plan_key=None
+        elif due:
+            age=self.__cache_age__(now)
+            if age is None:
+                log.info('cached production forecast file not found, calling solcast api')
+                self.__start__(now)
+            elif age < FETCH_MIN_AGE:
+                log.debug('cached production forecast still fresh, planned solcast api call deferred')
+                #spread the unused call over the rest of the day
+                self.plan_key=None
+            else:
+                self.__start__(now)
+        return updated
+
 class SolcastForecast(object):
 
     def __init__(self, auth_write):
@@ -195,9 +402,10 @@ class SolcastForecast(object):
         #other attributes
         self.url = None
         self.prod={}
+        #end of the period covered by the production forecast (local time)
+        self.prod_end=None
         self.cons={}
         self.out_max=0
-        self.solcast_forecast_called = False
         self.solcast_forecast_available = False
         #if program starts at time when update is supposed to be called
         self.values_update_called=False #set to False to prevent launching the consumption update 
@@ -233,43 +441,25 @@ class SolcastForecast(object):
         with open(filename, mode="w", encoding="utf-8") as file:
             json.dump(self.cons, file)
 
-    #to load the production forecast from a json saved in a file (for testing purpose only)
+    #to load the production forecast from the cache file written by the fetch planner
     def __read_prod__(self):
         filename=self.file_path+'/prod_forecast.json'
         if os.path.isfile(filename):
             with open(filename, mode="r", encoding="utf-8") as file:
                 self.prod = json.load(file)
-            #check if forecast is younger than 3 hours
-            td = datetime.utcnow() + timedelta(minutes=30) - datetime.strptime(
-                self.prod['forecasts'][0]["period_end"], "%Y-%m-%dT%H:%M:%S.0000000Z")
-            if td.days==0 and td.seconds<=10800:
-                 return True
-            else:
+            #a cache without any forecasted period is not a forecast
+            if not self.prod.get('forecasts'):
+                self.prod_end=None
                 return False
+            #adjust end of the last forecasted period to local time
+            self.prod_end=datetime.strptime(self.prod['forecasts'][-1]["period_end"], "%Y-%m-%dT%H:%M:%S.0000000Z")\
+                        .replace(tzinfo=timezone(timedelta(seconds=0), 'UTC'))\
+                        .astimezone()\
+                        .replace(tzinfo=None)
+            return True
         else:
             return False
 
-    #to save production forecast as a json into a file (not used)
-    def __save_prod__(self):
-        filename=self.file_path+'/prod_forecast.json'
-        with open(filename, mode="w", encoding="utf-8") as file:
-            json.dump(self.prod, file)
-
-    #to retrieve the production forecast from the solcast url
-    def __curl_prod__(self):
-        log.debug('Calling Solcast API url')
-        try:
-            self.prod=json.load(os.popen("curl -s "+self.url))
-            if "forecasts" in self.prod:
-                return True
-            elif "response_status" in self.prod and "error_code" in self.prod["response_status"]:
-                log.error(f'error received from Solcast API: {self.prod["response_status"]["error_code"]}')
-            else:
-                log.error('unidentified error when contacting Solcast API')
-        except:
-            log.error('non interpretable answer received from Solcast API')
-        return False
-
     #to validate value change on the dbus service
     def __callback_authwrite_change__(self, path, newvalue):
         if not newvalue:
@@ -522,13 +712,18 @@ class SolcastForecast(object):
                 os._exit(1)
             
             #initialize the solcast url (read from file)
-            self.__read_url__()
+            if not self.__read_url__():
+                log.error('could not read solcast url, production forecast will not be updated')
+
+            #initialize the planner of solcast api calls
+            self.fetch_planner = FetchPlanner(self.file_path, self.url)
 
-            #read the production forecast in the file
-            self.solcast_forecast_available = self.__read_prod__()
+            #read the production forecast in the cache file
+            if not self.__read_prod__():
+                log.info('could not read cached production forecast')
+            self.solcast_forecast_available = self.fetch_planner.usable(self.prod_end, datetime.now())
             if not self.solcast_forecast_available:
-                log.info('could not read recent production forecast')
-                log.info('waiting for current 30 mn period to end to curl solcast api')
+                log.info('waiting for a recent production forecast covering today and tomorrow')
         except:
             log.error('exception occured during init', exc_info=True)
             os._exit(1)
@@ -541,12 +736,12 @@ class SolcastForecast(object):
             self.__soft_exit__()
 
         #run updates when required
-        #we use self.values_update_called and self.forecast_update_called
+        #we use self.values_update_called and self.out_max_calculated
         # to avoid calling again and again the same update if an exception has occured
         #we use self.values_update_ready
         # to update the consumption only if a full 30 mn period has been completed after init
         #we use self.solcast_forecast_available
-        # to calculate a new forecast as soon as a new hour starts after init
+        # to calculate a new forecast only while the cached production forecast is recent and covers today and tomorrow
         try:
             #every day reset the values
             if datetime.now().hour == 0 and not self.values_reset:
@@ -556,19 +751,19 @@ class SolcastForecast(object):
             #reset
             if (datetime.now().hour != 0) and self.values_reset:
                 self.values_reset = False
-            #every 3 hours download the forecast
-            if ((not(datetime.now().hour % 3) 
-                or (not datetime.now().minute % 30 and not self.solcast_forecast_available))
-                and not self.solcast_forecast_called):
-                #curl solcast api
-                self.solcast_forecast_called = True
-                if self.__curl_prod__():
-                    self.solcast_forecast_available = True
-                    self.__save_prod__()
-                    log.debug('production_forecast saved to file')
-            #reset
-            if datetime.now().hour % 3 and self.solcast_forecast_called:
-                self.solcast_forecast_called = False
+            #download the forecast when planned, the call runs in background
+            # and the cached forecast is used until the answer is received
+            if self.fetch_planner.update(self.prod_end):
+                self.__read_prod__()
+                log.debug('production forecast updated from solcast api')
+            #stop the out_max calculation when the cached forecast gets outdated
+            available = self.fetch_planner.usable(self.prod_end, datetime.now())
+            if self.solcast_forecast_available and not available:
+                log.error(
+                    'cached production forecast outdated or not covering today and tomorrow, '
+                    +'out_max not calculated until a new forecast is received'
+                    )
+            self.solcast_forecast_available = available
 
             #every 30 mn period update values, save consumption and calculate the forecast
             if not(datetime.now().minute % 30):
@@ -0,0 +1,228 @@
+#checks of the solcast api call planning (venus os modules are replaced in conftest.py when missing)
+import os
+import json
+from datetime import datetime, timedelta
+
+import solcastforecast
+from solcastforecast import FetchPlanner
+
+#file url so that a call started by mistake never reaches solcast
+URL = "'file:///nonexistent/prod_forecast.json'"
+
+def planner_for(tmp_path, now, used=0):
+    with open(tmp_path/'solcast_quota.json', mode="w", encoding="utf-8") as file:
+        json.dump({'date' : now.astimezone(solcastforecast.timezone.utc).strftime('%Y-%m-%d'), 'used' : used}, file)
+    return FetchPlanner(str(tmp_path), URL)
+
+def write_cache(tmp_path, mtime):
+    filename=tmp_path/'prod_forecast.json'
+    filename.write_text('{"forecasts": []}')
+    os.utime(filename, (mtime.timestamp(), mtime.timestamp()))
+
+def hours(plan):
+    return [item.strftime('%H:%M') for item in plan]
+
+def test_sun_times_paris():
+    planner=FetchPlanner('/nonexistent', None)
+    sunrise, sunset = planner.__sun_times__(datetime(2026, 6, 21).date())
+    assert abs(sunrise-datetime(2026, 6, 21, 5, 47)) < timedelta(minutes=5)
+    assert abs(sunset-datetime(2026, 6, 21, 21, 58)) < timedelta(minutes=5)
+    sunrise, sunset = planner.__sun_times__(datetime(2026, 12, 21).date())
+    assert abs(sunrise-datetime(2026, 12, 21, 8, 42)) < timedelta(minutes=5)
+    assert abs(sunset-datetime(2026, 12, 21, 16, 56)) < timedelta(minutes=5)
+
+def test_plan_full_day(tmp_path):
+    now=datetime(2026, 10, 19, 0, 10)
+    planner=planner_for(tmp_path, now)
+    planner.__plan__(now)
+    assert hours(planner.plan) == [
+        '08:25', '09:25', '10:25', '11:25', '12:25', '13:25', '14:25', '15:25', '16:25', '17:25'
+        ]
+
+def test_plan_winter_day_first_call_after_sunrise(tmp_path):
+    now=datetime(2026, 12, 21, 0, 10)
+    planner=planner_for(tmp_path, now)
+    planner.__plan__(now)
+    assert len(planner.plan) == solcastforecast.SOLCAST_DAILY_LIMIT
+    assert hours(planner.plan)[0] == '08:55'
+    assert planner.plan == sorted(set(planner.plan))
+
+def test_plan_restart_uses_all_calls_left(tmp_path):
+    #calls left expire at 00:00 utc, they are all spread over the remaining daylight
+    now=datetime(2026, 10, 19, 12, 0)
+    planner=planner_for(tmp_path, now)
+    planner.__plan__(now)
+    assert hours(planner.plan) == [
+        '12:25', '12:55', '13:25', '13:55', '14:55', '15:25', '15:55', '16:55', '17:25', '17:55'
+        ]
+
+def test_plan_restart_limited_by_quota(tmp_path):
+    now=datetime(2026, 10, 19, 9, 5)
+    planner=planner_for(tmp_path, now, used=8)
+    planner.__plan__(now)
+    assert len(planner.plan) == 2
+
+def test_plan_after_sunset_is_empty(tmp_path):
+    now=datetime(2026, 10, 19, 20, 0)
+    planner=planner_for(tmp_path, now)
+    planner.__plan__(now)
+    assert planner.plan == []
+
+def test_plan_polar_night(tmp_path, monkeypatch):
+    monkeypatch.setattr(solcastforecast, 'SITE_LATITUDE', 78.0)
+    now=datetime(2026, 12, 21, 0, 10)
+    planner=planner_for(tmp_path, now)
+    planner.__plan__(now)
+    assert planner.plan == []
+
+def test_plan_midnight_sun_stays_within_the_day(tmp_path, monkeypatch):
+    monkeypatch.setattr(solcastforecast, 'SITE_LATITUDE', 78.0)
+    now=datetime(2026, 6, 21, 0, 10)
+    planner=planner_for(tmp_path, now)
+    planner.__plan__(now)
+    assert len(planner.plan) == solcastforecast.SOLCAST_DAILY_LIMIT
+    assert all(item.date() == now.date() for item in planner.plan)
+
+def test_quota_rollover_at_utc_midnight(tmp_path):
+    #local day starts at 00:00 (22:00 utc in summer) but solcast quota only resets at 00:00 utc
+    write_cache(tmp_path, datetime(2026, 6, 21, 0, 0))
+    prod_end=datetime(2026, 6, 28)
+    planner=planner_for(tmp_path, datetime(2026, 6, 20, 23, 0), used=solcastforecast.SOLCAST_DAILY_LIMIT)
+    planner.update(prod_end, datetime(2026, 6, 21, 0, 30))
+    assert planner.plan == []
+    assert planner.process is None
+    planner.update(prod_end, datetime(2026, 6, 21, 2, 30))
+    assert planner.quota == {'date' : '2026-06-21', 'used' : 0}
+    assert len(planner.plan) == solcastforecast.SOLCAST_DAILY_LIMIT
+    assert planner.process is None
+
+def test_deferred_call_forces_replan(tmp_path):
+    write_cache(tmp_path, datetime(2026, 10, 19, 9, 20))
+    prod_end=datetime(2026, 10, 26)
+    planner=planner_for(tmp_path, datetime(2026, 10, 19, 9, 0))
+    planner.update(prod_end, datetime(2026, 10, 19, 9, 0))
+    assert hours(planner.plan)[0] == '09:25'
+    #cache retrieved 6 mn before the planned call, the call is deferred
+    planner.update(prod_end, datetime(2026, 10, 19, 9, 26))
+    assert planner.process is None
+    assert planner.plan_key is None
+    assert planner.quota['used'] == 0
+    planner.update(prod_end, datetime(2026, 10, 19, 9, 27))
+    assert hours(planner.plan)[0] == '09:55'
+    #the deferred call is kept for the rest of the day
+    assert len(planner.plan) == solcastforecast.SOLCAST_DAILY_LIMIT
+
+class FinishedCall(object):
+    #curl process already terminated with the given exit code
+    def __init__(self, returncode):
+        self.returncode=returncode
+
+    def poll(self):
+        return self.returncode
+
+def answer(tmp_path, prod, returncode=0):
+    (tmp_path/'prod_forecast.json.tmp').write_text(json.dumps(prod))
+    planner=planner_for(tmp_path, datetime.now(), used=1)
+    planner.process=FinishedCall(returncode)
+    return planner
+
+def test_poll_good_answer_replaces_cache(tmp_path):
+    prod={'forecasts' : [{'period_end' : '2026-10-19T10:00:00.0000000Z'}]}
+    (tmp_path/'prod_forecast.json').write_text('{"forecasts": []}')
+    planner=answer(tmp_path, prod)
+    assert planner.__poll__()
+    assert planner.process is None
+    assert json.loads((tmp_path/'prod_forecast.json').read_text()) == prod
+    assert not (tmp_path/'prod_forecast.json.tmp').exists()
+
+def test_poll_empty_forecasts_ignored(tmp_path):
+    planner=answer(tmp_path, {'forecasts' : []})
+    assert not planner.__poll__()
+    assert planner.process is None
+    assert not (tmp_path/'prod_forecast.json').exists()
+
+def test_poll_too_many_requests_uses_quota(tmp_path):
+    planner=answer(tmp_path, {'response_status' : {'error_code' : 'TooManyRequests'}})
+    assert not planner.__poll__()
+    assert planner.quota['used'] == solcastforecast.SOLCAST_DAILY_LIMIT
+    assert json.loads((tmp_path/'solcast_quota.json').read_text())['used'] == solcastforecast.SOLCAST_DAILY_LIMIT
+
+def test_poll_curl_failure_ignored(tmp_path):
+    planner=answer(tmp_path, {'forecasts' : [{'period_end' : '2026-10-19T10:00:00.0000000Z'}]}, returncode=28)
+    assert not planner.__poll__()
+    assert planner.process is None
+    assert not (tmp_path/'prod_forecast.json').exists()
+    assert planner.quota['used'] == 1
+
+def test_usable_horizon(tmp_path):
+    now=datetime(2026, 10, 19, 12, 0)
+    write_cache(tmp_path, now-timedelta(hours=1))
+    planner=FetchPlanner(str(tmp_path), URL)
+    assert planner.usable(datetime(2026, 10, 21, 0, 0), now)
+    assert not planner.usable(datetime(2026, 10, 20, 23, 30), now)
+    assert not planner.usable(None, now)
+
+def test_usable_max_age(tmp_path):
+    now=datetime(2026, 10, 19, 12, 0)
+    planner=FetchPlanner(str(tmp_path), URL)
+    prod_end=datetime(2026, 10, 26)
+    assert not planner.usable(prod_end, now)
+    write_cache(tmp_path, now-timedelta(seconds=solcastforecast.FORECAST_MAX_AGE))
+    assert planner.usable(prod_end, now)
+    write_cache(tmp_path, now-timedelta(seconds=solcastforecast.FORECAST_MAX_AGE+60))
+    assert not planner.usable(prod_end, now)
+
+def test_read_prod_converts_end_to_local_time(tmp_path):
+    forecast=solcastforecast.SolcastForecast(True)
+    forecast.file_path=str(tmp_path)
+    (tmp_path/'prod_forecast.json').write_text(json.dumps({'forecasts' : [
+        {'period_end' : '2026-06-21T09:30:00.0000000Z'},
+        {'period_end' : '2026-06-21T10:00:00.0000000Z'},
+        ]}))
+    assert forecast.__read_prod__()
+    assert forecast.prod_end == datetime(2026, 6, 21, 12, 0)
+    (tmp_path/'prod_forecast.json').write_text(json.dumps({'forecasts' : [
+        {'period_end' : '2026-12-21T10:00:00.0000000Z'},
+        ]}))
+    assert forecast.__read_prod__()
+    assert forecast.prod_end == datetime(2026, 12, 21, 11, 0)
+
+def test_read_prod_without_forecasts(tmp_path):
+    forecast=solcastforecast.SolcastForecast(True)
+    forecast.file_path=str(tmp_path)
+    (tmp_path/'prod_forecast.json').write_text('{"forecasts": []}')
+    assert not forecast.__read_prod__()
+    assert forecast.prod_end is None
+    (tmp_path/'prod_forecast.json').write_text('{"response_status": {}}')
+    assert not forecast.__read_prod__()
+
+def test_read_quota_rejects_unexpected_content(tmp_path):
+    for content in ['{"date": "2026-10-19"}', '{"used": 3}', '{"date": "2026-10-19", "used": "3"}', '[]', '3']:
+        (tmp_path/'solcast_quota.json').write_text(content)
+        planner=FetchPlanner(str(tmp_path), URL)
+        assert planner.quota == {'date' : None, 'used' : 0}
+        assert planner.__remaining__(datetime(2026, 10, 19, 12, 0)) == solcastforecast.SOLCAST_DAILY_LIMIT
+
+def test_read_quota(tmp_path):
+    (tmp_path/'solcast_quota.json').write_text('{"date": "2026-10-19", "used": 3}')
+    planner=FetchPlanner(str(tmp_path), URL)
+    assert planner.__remaining__(datetime(2026, 10, 19, 12, 0)) == solcastforecast.SOLCAST_DAILY_LIMIT-3
+
+def test_retries_keep_quota_for_daylight(tmp_path, monkeypatch):
+    monkeypatch.setattr(solcastforecast.subprocess, 'Popen', lambda *args, **kwargs: FinishedCall(None))
+    #no cache file: the forecast is not usable
+    planner=planner_for(tmp_path, datetime(2026, 10, 19, 3, 0))
+    for hour, minute in [(3, 0), (3, 30), (4, 0), (4, 30)]:
+        planner.update(None, datetime(2026, 10, 19, hour, minute))
+        planner.process=None
+    assert planner.quota['used'] == solcastforecast.FETCH_NIGHT_RETRIES
+    #during daylight retries go on and the calls left are planned again
+    planner.update(None, datetime(2026, 10, 19, 9, 0))
+    assert planner.quota['used'] == solcastforecast.FETCH_NIGHT_RETRIES+1
+    planner.process=None
+    planner.update(None, datetime(2026, 10, 19, 9, 1))
+    assert planner.quota['used'] == solcastforecast.FETCH_NIGHT_RETRIES+1
+    assert len(planner.plan) == solcastforecast.SOLCAST_DAILY_LIMIT-solcastforecast.FETCH_NIGHT_RETRIES-1
+    #after sunset the calls left can be used
+    planner.update(None, datetime(2026, 10, 19, 20, 0))
+    assert planner.quota['used'] == solcastforecast.FETCH_NIGHT_RETRIES+2